@@ -0,0 +1,47 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* Test-only PWM meter. Measures the period of the selected output channel in
+   clk cycles so the cocotb test can read it once instead of timestamping
+   every edge in Python.
+*/
+module pwm_meter (
+    input  wire        clk,
+    input  wire        rst_n,
+    input  wire [15:0] pwm,       // {uio_out, uo_out}
+    input  wire [3:0]  channel,   // channel to measure
+    output reg  [31:0] period     // cycles between the last two rising edges (0 until measured)
+);
+
+    wire sample = pwm[channel];
+    reg sample_prev;
+    reg [3:0] channel_prev;
+    reg seen_rising;
+    reg [31:0] period_count;
+
+    always @(posedge clk or negedge rst_n) begin
+        if (!rst_n) begin
+            sample_prev <= 0;
+            channel_prev <= 0;
+            seen_rising <= 0;
+            period_count <= 0;
+            period <= 0;
+        end else begin
+            sample_prev <= sample;
+            channel_prev <= channel;
+            if (channel != channel_prev) begin
+                // New channel selected, discard the previous measurement
+                seen_rising <= 0;
+                period <= 0;
+            end else if (sample && !sample_prev) begin
+                if (seen_rising)
+                    period <= period_count;
+                seen_rising <= 1;
+                period_count <= 1;
+            end else begin
+                period_count <= period_count + 1;
+            end
+        end
+    end
+
+endmodule
@@ -22,6 +22,11 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // SPI clock (100 kHz), generated here so the cocotb driver only has to
+  // follow it rather than toggle ui_in[0] itself. ui_in[0] is unused.
+  reg sclk = 1'b0;
+  always #5000 sclk = ~sclk;
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -36,7 +41,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  ({ui_in[7:1], sclk}),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path
@@ -46,4 +51,16 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+  // Test-only PWM measurement, channel selected from cocotb
+  reg [3:0] pwm_meter_channel = 4'd0;
+  wire [31:0] pwm_period;
+
+  pwm_meter meter (
+      .clk    (clk),
+      .rst_n  (rst_n),
+      .pwm    ({uio_out, uo_out}),
+      .channel(pwm_meter_channel),
+      .period (pwm_period)
+  );
+
 endmodule
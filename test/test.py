@@ -1,26 +1,25 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+import numpy as np
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import RisingEdge
+from cocotb.triggers import FallingEdge
 from cocotb.triggers import ClockCycles
-from cocotb.types import Logic
+from cocotb.triggers import Timer
+from cocotb.triggers import Edge
+from cocotb.triggers import ReadOnly
+from cocotb.triggers import with_timeout
+from cocotb.result import SimTimeoutError
 from cocotb.types import LogicArray
 
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
+# ui_in encodings as plain ints so no LogicArray is built per bit.
+# ui_in[2] is nCS, ui_in[1] is COPI; SCLK (ui_in[0]) is driven by tb.v.
+UI_IN_IDLE = 0b100              # nCS high
+UI_IN_COPI = (0b000, 0b010)     # nCS low, indexed by the COPI bit
 
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
+# ui_in values that shift out each byte MSB first, so a transaction is two lookups
+SPI_BYTE_UI_IN = [tuple(UI_IN_COPI[(byte >> (7-i)) & 0x1] for i in range(8)) for byte in range(256)]
 
 async def send_spi_transaction(dut, r_w, address, data):
     """
@@ -39,170 +38,162 @@ async def send_spi_transaction(dut, r_w, address, data):
         data_int = int(data)
     else:
         data_int = data
-    # Validate inputs
-    if address < 0 or address > 127:
-        raise ValueError("Address must be 7-bit (0-127)")
-    if data_int < 0 or data_int > 255:
-        raise ValueError("Data must be 8-bit (0-255)")
+    # Validate inputs (skipped under python -O)
+    if __debug__:
+        if address < 0 or address > 127:
+            raise ValueError("Address must be 7-bit (0-127)")
+        if data_int < 0 or data_int > 255:
+            raise ValueError("Data must be 8-bit (0-255)")
     # Combine RW and address into first byte
     first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
-
-@cocotb.test()
-async def test_spi(dut):
-    dut._log.info("Start SPI test") 
-
+    ui_in_seq = SPI_BYTE_UI_IN[first_byte] + SPI_BYTE_UI_IN[data_int]
+    # SCLK is free-running in tb.v: COPI changes on the falling edge and is
+    # sampled on the rising edge. CS goes low together with the first bit.
+    ui_in = dut.ui_in
+    for value in ui_in_seq:
+        await FallingEdge(dut.sclk)
+        ui_in.value = value
+    # End transaction - return CS high after the last rising edge
+    await FallingEdge(dut.sclk)
+    ui_in.value = UI_IN_IDLE
+    # Give the peripheral 600 clock cycles (60 us) to latch the transaction
+    await Timer(60, units="us")
+    return UI_IN_IDLE
+
+async def bringup(dut):
+    """Start the 10 MHz clock, idle the SPI inputs and reset the DUT.
+
+    Returns the forked clock task.
+    """
     # Set the clock period to 100 ns (10 MHz)
     clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
+    clk_task = cocotb.start_soon(clock.start())
 
     # Reset
     dut._log.info("Reset")
     dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
+    dut.ui_in.value = UI_IN_IDLE
     dut.rst_n.value = 0
     await ClockCycles(dut.clk, 5)
     dut.rst_n.value = 1
     await ClockCycles(dut.clk, 5)
+    return clk_task
+
+@cocotb.test()
+async def test_spi(dut):
+    dut._log.info("Start SPI test") 
+
+    await bringup(dut)
 
     dut._log.info("Test project behavior")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
     ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
+    await ReadOnly()
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 1000) 
+    await Timer(100, units="us")
 
     dut._log.info("Write transaction, address 0x01, data 0xCC")
     ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
+    await ReadOnly()
     assert dut.uio_out.value == 0xCC, f"Expected 0xCC, got {dut.uio_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x30 (invalid), data 0xAA")
     ui_in_val = await send_spi_transaction(dut, 1, 0x30, 0xAA)
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
 
     dut._log.info("Read transaction (invalid), address 0x00, data 0xBE")
     ui_in_val = await send_spi_transaction(dut, 0, 0x30, 0xBE)
+    await ReadOnly()
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
     
     dut._log.info("Read transaction (invalid), address 0x41 (invalid), data 0xEF")
     ui_in_val = await send_spi_transaction(dut, 0, 0x41, 0xEF)
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x02, data 0xFF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 100)
+    await Timer(10, units="us")
 
     dut._log.info("Write transaction, address 0x04, data 0xCF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0xFF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0x00")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await Timer(3, units="ms")
 
     dut._log.info("Write transaction, address 0x04, data 0x01")
     ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await Timer(3, units="ms")
 
     dut._log.info("SPI test completed successfully")
 
 
-async def receive_pwm_sample(dut, signal, channel):
-    period = 100 # in ns
-    max_time = 4000000 # in ns
+async def receive_pwm_sample(signal, channel):
+    max_time = 4 # in ms, if the sample isn't complete by then the signal is considered stuck
     cycles = 2 #number of cycles to wait
 
-    num_of_rising = []
-    num_of_falling = []
-    high_times = []
-    prev_edge = (int(signal.value) >> channel) & 0x1
+    # Preallocated timestamp buffers (ns, float like get_sim_time); at most
+    # cycles+1 rising edges and as many high times
+    num_of_rising = np.empty(cycles + 1, dtype=np.float64)
+    high_times = np.empty(cycles + 1, dtype=np.float64)
+    rising_count = 0
+    high_count = 0
+    mask = 1 << channel
+    prev_edge = int(signal.value) & mask
 
     last_high = 0
-    last_low = 0
-    
-    start_time = cocotb.utils.get_sim_time(units="ns")
 
-    while len(num_of_rising) <= cycles:
-        await ClockCycles(dut.clk, 1)
-        
-        curr_time = cocotb.utils.get_sim_time(units="ns")
-        curr_edge = (int(signal.value) >> channel) & 0x1
+    get_sim_time = cocotb.utils.get_sim_time
+    # One deadline for the whole sample, in simulator steps so it stays exact.
+    # Changes on other bits of the bus must not extend it.
+    deadline = get_sim_time(units="step") + cocotb.utils.get_sim_steps(max_time, "ms")
 
+    while rising_count <= cycles:
+        # Wake only when the bus changes, or when the deadline passes
+        remaining = deadline - get_sim_time(units="step")
         #If signal is stuck
-        if (curr_time - start_time) > max_time:
-            if (curr_edge == 1):
-                return 1, 0
-            elif (curr_edge == 0):
-                return 0, 0
-            
-        #Otherwise, check for rising edge/falling edge and append
-        if ((curr_edge == 1) and (prev_edge == 0)):
-            num_of_rising.append(curr_time)
+        if remaining <= 0:
+            return (1 if int(signal.value) & mask else 0), 0
+        try:
+            await with_timeout(Edge(signal), remaining, "step")
+        except SimTimeoutError:
+            return (1 if int(signal.value) & mask else 0), 0
+        # Sample once the timestep has settled
+        await ReadOnly()
+
+        curr_time = get_sim_time(units="ns")
+        curr_edge = int(signal.value) & mask
+
+        #Check for rising edge/falling edge and record
+        if (curr_edge and not prev_edge):
+            num_of_rising[rising_count] = curr_time
+            rising_count += 1
             last_high = curr_time
-        elif ((curr_edge == 0) and (prev_edge == 1)):
-            num_of_falling.append(curr_time)
+        elif (prev_edge and not curr_edge):
             if (last_high != 0):
-                high_times.append(curr_time - last_high)
-            last_low = curr_time
+                high_times[high_count] = curr_time - last_high
+                high_count += 1
 
         prev_edge = curr_edge
 
-    periods = []
-    for t1, t2 in zip(num_of_rising, num_of_rising[1:]):
-        periods.append(t2 - t1)
+    periods = np.diff(num_of_rising[:rising_count])
 
-    if not high_times:
+    if high_count == 0:
         avg_high_times = 0
     else:
-        avg_high_times = sum(high_times)/len(high_times)
+        avg_high_times = high_times[:high_count].mean()
 
-    if not periods:
+    if periods.size == 0:
         avg_period = 0
     else:
-        avg_period = sum(periods)/len(periods)
+        avg_period = periods.mean()
 
     if (avg_period > 0):
         frequency = 1E9/avg_period
@@ -213,39 +204,40 @@ async def receive_pwm_sample(dut, signal, channel):
 
     return duty, frequency
 
+async def read_pwm_meter(dut, channel):
+    """
+    Measure a PWM output frequency with the pwm_meter in tb.v.
+
+    Parameters:
+    - channel: int, output channel (0-7 on uo_out, 8-15 on uio_out)
+
+    Returns the frequency of the last complete PWM period, or 0 if no full
+    period was seen.
+    """
+    period = 100 # clk period in ns
+    dut.pwm_meter_channel.value = channel
+    # 1 ms covers three PWM periods (~333 us each), enough for two rising edges
+    await Timer(1, units="ms")
+    period_cycles = int(dut.pwm_period.value)
+    if period_cycles == 0:
+        return 0
+    return 1E9/(period_cycles*period)
+
 @cocotb.test()
 async def test_pwm_freq(dut):
     dut._log.info("Start PWM Frequency test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await bringup(dut)
 
     await send_spi_transaction(dut, 1, 0x04, 0x80) # 50% duty cycle (128 in hex for 128/256 x 100% = 50%)
     
     dut._log.info("Testing ui_out frequencies (Output & PWM channels 0-7)")
     for i in range(8):
-        dut._log.info("Writing to Output channel %d", i)
+        dut._log.info("Enabling Output & PWM channel %d", i)
         ui_in_val = await send_spi_transaction(dut, 1, 0x00, 1<<i)
-
-        dut._log.info("Writing to PWM channel %d", i)
         ui_in_val = await send_spi_transaction(dut, 1, 0x02, 1<<i)
 
-        dut._log.info("Reading PWM channel %d", i)
-        duty, frequency = await receive_pwm_sample(dut, dut.uo_out, channel=i)
-
+        frequency = await read_pwm_meter(dut, channel=i)
 
         assert 2970 <= frequency <= 3030, f"Expected frequency around 3000Hz +- 1% on channel {i}, got {frequency}"
         ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0)
@@ -253,14 +245,11 @@ async def test_pwm_freq(dut):
 
     dut._log.info("Testing uio_out frequencies (Output & PWM channels 8-15)")
     for i in range(8):
-        dut._log.info("Writing to Output channel %d", i+8)
+        dut._log.info("Enabling Output & PWM channel %d", i+8)
         ui_in_val = await send_spi_transaction(dut, 1, 0x01, 1<<i)
-        
-        dut._log.info("Writing to PWM channel %d", i+8)
         ui_in_val = await send_spi_transaction(dut, 1, 0x03, 1<<i)
 
-        dut._log.info("Reading PWM channel %d", i+8)
-        duty, frequency = await receive_pwm_sample(dut, dut.uio_out, channel=i)
+        frequency = await read_pwm_meter(dut, channel=i+8)
 
         assert 2970 <= frequency <= 3030, f"Expected frequency around 3000Hz +- 1% on channel {i+8}, got {frequency}"
         ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0)
@@ -273,72 +262,54 @@ async def test_pwm_freq(dut):
 async def test_pwm_duty(dut):
     dut._log.info("Start PWM Duty test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await bringup(dut)
 
-    dut.log.info("Testing ui_out duty cycle (Output & PWM channels 0-7)")
+    dut._log.info("Testing ui_out duty cycle (Output & PWM channels 0-7)")
     for i in range(8):
-        dut._log.info("Writing to Output channel %d", i)
+        dut._log.info("Enabling Output & PWM channel %d", i)
         ui_in_val = await send_spi_transaction(dut, 1, 0x00, 1<<i)
-
-        dut._log.info("Writing to PWM channel %d", i)
         ui_in_val = await send_spi_transaction(dut, 1, 0x02, 1<<i)
 
         # 0% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0x00)
-        await ClockCycles(dut.clk, 10000)
-        duty, frequency = await receive_pwm_sample(dut, dut.uo_out, channel=i)
+        await Timer(1, units="ms")
+        duty, frequency = await receive_pwm_sample(dut.uo_out, channel=i)
         assert duty == 0, f"Expected 0% duty cycle on channel {i}, got {duty}"
 
         # 50% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0x80)
-        await ClockCycles(dut.clk, 10000)
-        duty, frequency = await receive_pwm_sample(dut, dut.uo_out, channel=i)
+        await Timer(1, units="ms")
+        duty, frequency = await receive_pwm_sample(dut.uo_out, channel=i)
         assert 0.499 <= duty <= 0.501, f"Expected 50% duty cycle on channel {i}, got {duty}"
 
         # 100% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0xFF)
-        await ClockCycles(dut.clk, 10000)
-        duty, frequency = await receive_pwm_sample(dut, dut.uo_out, channel=i)
+        await Timer(1, units="ms")
+        duty, frequency = await receive_pwm_sample(dut.uo_out, channel=i)
         assert duty == 1, f"Expected 100% duty cycle on channel {i}, got {duty}"
 
     ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0)
     ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0)
 
-    dut.log.info("Testing ui_out duty cycle (Output & PWM channels 8-15)")
+    dut._log.info("Testing uio_out duty cycle (Output & PWM channels 8-15)")
     for i in range(8):
-        dut._log.info("Writing to Output channel %d", i+8)
+        dut._log.info("Enabling Output & PWM channel %d", i+8)
         ui_in_val = await send_spi_transaction(dut, 1, 0x01, 1<<i)
-
-        dut._log.info("Writing to PWM channel %d", i+8)
         ui_in_val = await send_spi_transaction(dut, 1, 0x03, 1<<i)
 
         # 0% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0x00)
-        duty, frequency = await receive_pwm_sample(dut, dut.uio_out, channel=i)
+        duty, frequency = await receive_pwm_sample(dut.uio_out, channel=i)
         assert duty == 0, f"Expected 0% duty cycle on channel {i+8}, got {duty}"
 
         # 50% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0x80)
-        duty, frequency = await receive_pwm_sample(dut, dut.uio_out, channel=i)
+        duty, frequency = await receive_pwm_sample(dut.uio_out, channel=i)
         assert 0.499 <= duty <= 0.501, f"Expected 50% duty cycle on channel {i+8}, got {duty}"
 
         # 100% Duty cycle
         await send_spi_transaction(dut, 1, 0x04, 0xFF)
-        duty, frequency = await receive_pwm_sample(dut, dut.uio_out, channel=i)
+        duty, frequency = await receive_pwm_sample(dut.uio_out, channel=i)
         assert duty == 1, f"Expected 100% duty cycle on channel {i+8}, got {duty}"
 
     ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0)